@@ -1,17 +1,35 @@
 from flask import Flask, render_template, request, send_file, jsonify
+import numpy as np
 import pandas as pd
 import os
 from datetime import datetime
 from werkzeug.utils import secure_filename
-import io
+import concurrent.futures
+import hashlib
+import shutil
+import threading
+import time
 import traceback
 import gc
 
+MAX_FILE_SIZE = 10 * 1024 * 1024  # 单个文件限制10MB
+
 app = Flask(__name__)
-app.config['MAX_CONTENT_LENGTH'] = 10 * 1024 * 1024  # 限制10MB（减少到10MB）
+# 两个文件的预算再留1MB multipart报文开销；/process入口按同一阈值先行友好拒绝
+app.config['MAX_CONTENT_LENGTH'] = 2 * MAX_FILE_SIZE + 1024 * 1024
 app.config['UPLOAD_FOLDER'] = '/tmp/uploads'
+app.config['BOOK_CACHE_FOLDER'] = '/tmp/uploads/cache'
+# 部署在nginx(X-Accel-Redirect)/Apache后面时设USE_X_SENDFILE=1，
+# 下载的字节由前端服务器发送，Python worker立即空出来接下一个请求
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE', '0') == '1'
 
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+os.makedirs(app.config['BOOK_CACHE_FOLDER'], exist_ok=True)
+
+# 结果文件按mtime过期清扫；下载完立刻删会和内核sendfile竞争
+RESULT_TTL_SECONDS = 15 * 60
+# 教材表缓存只保留最近的几份，防止多样化上传把小盘写满
+BOOK_CACHE_MAX_FILES = 8
 
 STUDENT_COLUMN_MAP = {
     '学号': '学号',
@@ -26,6 +44,24 @@ BOOK_COLUMN_MAP = {
     'ISBN': 'ISBN',
 }
 
+# 读取时直接按string解析，省掉后面整列astype(str)的二次转换
+# Arrow后端的字符串存在连续buffer里，没有每格一个Python str对象的开销
+STUDENT_DTYPE = {
+    '学号': 'string[pyarrow]',
+    '姓名': 'string[pyarrow]',
+    '学院': 'string[pyarrow]',
+    '专业': 'string[pyarrow]',
+    '行政班': 'string[pyarrow]',
+    'ISBN': 'string[pyarrow]',
+}
+
+def pick_excel_engine(filepath):
+    # calamine(Rust实现)单遍解析xlsx，比openpyxl的DOM方式更快且省内存
+    # 老格式.xls用xlrd兜底
+    if str(filepath).lower().endswith('.xls'):
+        return 'xlrd'
+    return 'calamine'
+
 def map_columns(df, column_map):
     reverse_map = {v: k for k, v in column_map.items()}
     df_renamed = df.rename(columns=reverse_map)
@@ -35,69 +71,116 @@ def map_columns(df, column_map):
     return df_renamed
 
 def find_price_column(df):
-    for col in df.columns:
-        if '折后价' in col or '折后价'.lower() in col.lower():
-            return col
-    
-    discount_cols = [col for col in df.columns if '折' in col or 'discount' in col.lower()]
-    if discount_cols:
-        return discount_cols[0]
-    return None
+    # 向量化匹配列名（'折后价'没有ASCII字符，lower()是多余的；regex=False走字面量路径）
+    cols = df.columns.astype(str)
+    hit = cols[cols.str.contains('折后价', regex=False)]
+    if len(hit):
+        return hit[0]
+
+    hit = cols[cols.str.contains('折', regex=False) |
+               cols.str.lower().str.contains('discount', regex=False)]
+    return hit[0] if len(hit) else None
+
+def file_sha256(filepath):
+    # 8MB分块读取，大文件求摘要也不占内存
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(8 * 1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def read_student_table(student_file):
+    engine = pick_excel_engine(student_file)
+
+    # 先nrows=0验表头：缺列时报map_columns的中文提示，而不是pandas的usecols英文报错
+    header = pd.read_excel(student_file, engine=engine, nrows=0)
+    map_columns(header, STUDENT_COLUMN_MAP)
 
-def process_data(student_file, book_file, college_name):
+    return pd.read_excel(
+        student_file,
+        usecols=list(STUDENT_COLUMN_MAP.values()),
+        engine=engine,
+        dtype=STUDENT_DTYPE,
+        dtype_backend='pyarrow'
+    )
+
+def load_book_table(book_file):
+    # 按文件内容哈希缓存清洗好的教材表：同一份教材目录配不同学院关键词
+    # 反复查询时，命中缓存直接feather读回，免去重复解析Excel
+    cache_path = os.path.join(app.config['BOOK_CACHE_FOLDER'],
+                              f"{file_sha256(book_file)}.feather")
+    if os.path.exists(cache_path):
+        print("教材表命中缓存")
+        df_book = pd.read_feather(cache_path, dtype_backend='pyarrow')
+        return df_book, find_price_column(df_book)
+
+    engine = pick_excel_engine(book_file)
+
+    # 先nrows=0只取表头定位价格列，再用usecols只解析这两列，其余列在解析阶段直接跳过
+    header = pd.read_excel(book_file, engine=engine, nrows=0)
+    map_columns(header, {'ISBN': BOOK_COLUMN_MAP['ISBN']})
+
+    price_col_name = find_price_column(header)
+    if not price_col_name:
+        raise KeyError("未找到价格列（需包含'折后价'或'折'字）")
+
+    # 清洗（缓存里保留原始价格列名，命中时重新识别即可）
+    df_book = pd.read_excel(book_file, engine=engine,
+                            usecols=['ISBN', price_col_name],
+                            dtype={'ISBN': 'string[pyarrow]'},
+                            dtype_backend='pyarrow')
+    df_book['ISBN'] = df_book['ISBN'].str.strip()
+    df_book[price_col_name] = pd.to_numeric(df_book[price_col_name], errors='coerce')
+    # 重复ISBN保留首行：入缓存前显式去重，连接时才不会按多对多膨胀
+    df_book = (df_book.dropna(subset=[price_col_name])
+               .drop_duplicates('ISBN', keep='first'))
+
+    # 先写临时文件再原子rename：并发写同一份新文件不互相踩，读端也看不到半截文件
+    tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    df_book.reset_index(drop=True).to_feather(tmp_path)
+    os.replace(tmp_path, cache_path)
+    return df_book, price_col_name
+
+def process_data(student_file, book_file, college_name, include_detail=True):
     try:
-        # 使用较小的chunksize和只读必要的列来减少内存
-        print("开始读取学生表...")
-        df_student_raw = pd.read_excel(
-            student_file,
-            usecols=lambda x: x in STUDENT_COLUMN_MAP.values() or x in ['学号', '姓名', '学院', '专业', '行政班', 'ISBN'],
-            engine='openpyxl'
-        )
-        
+        # 两张表互不依赖，且calamine解析时释放GIL，双线程并行读省一段串行等待
+        print("开始读取学生表和教材表...")
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as ex:
+            fut_student = ex.submit(read_student_table, student_file)
+            fut_book = ex.submit(load_book_table, book_file)
+            df_student_raw = fut_student.result()
+            df_book, price_col_name = fut_book.result()
+
         df_student = map_columns(df_student_raw, STUDENT_COLUMN_MAP)
+        df_book = df_book.rename(columns={price_col_name: '折后价'})
         del df_student_raw
-        gc.collect()
-        
-        print("开始读取教材表...")
-        # 先只读ISBN列和可能的价格列
-        df_book_raw = pd.read_excel(book_file, engine='openpyxl', nrows=None)
-        
-        df_book_with_isbn = map_columns(df_book_raw, {'ISBN': BOOK_COLUMN_MAP['ISBN']})
-        
-        price_col_name = find_price_column(df_book_with_isbn)
-        if not price_col_name:
-            raise KeyError("未找到价格列（需包含'折后价'或'折'字）")
-        
-        # 只保留需要的列
-        df_book = df_book_with_isbn[['ISBN', price_col_name]].copy()
-        df_book.rename(columns={price_col_name: '折后价'}, inplace=True)
-        
-        del df_book_raw, df_book_with_isbn
-        gc.collect()
-        
+
         # 数据清洗
         df_student.dropna(subset=['学号', 'ISBN'], how='all', inplace=True)
-        df_student['学号'] = df_student['学号'].astype(str).str.strip()
-        df_student['ISBN'] = df_student['ISBN'].astype(str).str.strip()
-        
-        df_book.dropna(subset=['ISBN', '折后价'], how='all', inplace=True)
-        df_book['ISBN'] = df_book['ISBN'].astype(str).str.strip()
-        df_book['折后价'] = pd.to_numeric(df_book['折后价'], errors='coerce')
-        df_book = df_book[df_book['折后价'].notna()]
-        
-        # 只保留有价格的学生记录
-        df_student = df_student[df_student['ISBN'].isin(df_book['ISBN'])].copy()
-        
-        # 价格映射
-        price_dict = dict(zip(df_book['ISBN'], df_book['折后价']))
-        df_student['单册价格'] = df_student['ISBN'].map(price_dict)
-        df_student = df_student[df_student['单册价格'].notna()]
-        
-        del df_book, price_dict
-        gc.collect()
+        df_student['学号'] = df_student['学号'].str.strip()
+        df_student['ISBN'] = df_student['ISBN'].str.strip()
+
+        # 低基数列转category：分组时按整数码哈希而不是逐行哈希字符串，内存也随去重比例下降
+        # 学号/姓名基数高，保持string
+        for col in ['学院', '专业', '行政班']:
+            df_student[col] = df_student[col].astype('category')
+
+        # 价格映射：一次inner merge同时完成isin预过滤、价格查找和notna剪枝，
+        # 三次O(N)扫描合成一次哈希连接
+        df_student = df_student.merge(
+            df_book.rename(columns={'折后价': '单册价格'}),
+            on='ISBN',
+            how='inner',
+            validate='many_to_one'
+        )
+
+        del df_book
         
-        # 学院筛选
-        df_filtered = df_student[df_student['学院'].str.contains(college_name, na=False)].copy()
+        # 学院筛选：只对去重后的类目做一次子串匹配(regex=False按字面量匹配)，
+        # 再用整数码过滤全表，把O(N)次字符串扫描降为O(唯一学院数)次
+        college_cats = df_student['学院'].cat.categories
+        good_codes = np.flatnonzero(college_cats.str.contains(college_name, regex=False, na=False))
+        df_filtered = df_student[df_student['学院'].cat.codes.isin(good_codes)].copy()
         
         if df_filtered.empty:
             all_colleges = df_student['学院'].unique()[:10]
@@ -105,15 +188,28 @@ def process_data(student_file, book_file, college_name):
         
         unique_colleges = df_filtered['学院'].unique()
         
-        # 汇总计算
-        df_result = df_filtered.groupby(
-            ['学号', '姓名', '学院', '专业', '行政班'],
-            as_index=False
-        )['单册价格'].sum()
-        df_result.rename(columns={'单册价格': '教材采购总费用'}, inplace=True)
-        
-        df_detail = df_filtered[['学号', '姓名', '学院', '专业', '行政班', 'ISBN', '单册价格']].copy()
-        df_detail['个人总计'] = df_detail.groupby('学号')['单册价格'].transform('sum')
+        # 汇总计算：学号唯一确定其余四个键，factorize出整数码后用bincount
+        # 按码累加(即out[code]+=price的C内核)，跳过groupby聚合的哈希/排序/take开销
+        codes, uniques = pd.factorize(df_filtered['学号'], sort=False)
+        prices = df_filtered['单册价格'].to_numpy(dtype='float64')
+        valid = codes >= 0  # factorize把缺失学号标成-1，照旧丢弃(与groupby丢NaN键一致)
+        totals = pd.Series(
+            np.bincount(codes[valid], weights=prices[valid], minlength=len(uniques)),
+            index=pd.Index(uniques, name='学号'),
+            name='教材采购总费用'
+        )
+        df_result = (
+            df_filtered.drop_duplicates('学号')[['学号', '姓名', '学院', '专业', '行政班']]
+            .merge(totals, on='学号')
+        )
+
+        # 明细表行数最多、序列化最贵，默认不生成，勾选了才算
+        df_detail = None
+        if include_detail:
+            df_detail = df_filtered[['学号', '姓名', '学院', '专业', '行政班', 'ISBN', '单册价格']].copy()
+            # 个人总计直接拿factorize码对totals数组做take，连map的逐行哈希探测都省掉
+            per_row = totals.to_numpy()[np.maximum(codes, 0)]
+            df_detail['个人总计'] = np.where(valid, per_row, np.nan)
         
         summary = {
             '统计时间': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
@@ -126,7 +222,6 @@ def process_data(student_file, book_file, college_name):
         }
         
         del df_student, df_filtered
-        gc.collect()
         
         print("数据处理完成")
         
@@ -159,12 +254,17 @@ def process():
     book_path = None
     
     try:
+        # 先按Content-Length整体拒掉超限请求，注定失败的上传不做multipart解析、不落盘
+        if request.content_length and request.content_length > app.config['MAX_CONTENT_LENGTH']:
+            return jsonify({"success": False, "error": "文件过大，单个文件请不要超过10MB"})
+
         if 'student_file' not in request.files or 'book_file' not in request.files:
             return jsonify({"success": False, "error": "请上传两个Excel文件"})
         
         student_file = request.files['student_file']
         book_file = request.files['book_file']
         college_name = request.form.get('college_name', '').strip()
+        include_detail = request.form.get('include_detail', '0') == '1'
         
         if not college_name:
             return jsonify({"success": False, "error": "请输入学院关键词"})
@@ -176,48 +276,40 @@ def process():
                 book_file.filename.endswith(('.xlsx', '.xls'))):
             return jsonify({"success": False, "error": "请上传Excel文件(.xlsx或.xls格式)"})
         
-        # 检查文件大小
-        student_file.seek(0, os.SEEK_END)
-        student_size = student_file.tell()
-        student_file.seek(0)
-        
-        book_file.seek(0, os.SEEK_END)
-        book_size = book_file.tell()
-        book_file.seek(0)
-        
-        if student_size > 10 * 1024 * 1024 or book_size > 10 * 1024 * 1024:
-            return jsonify({"success": False, "error": "文件过大，单个文件请不要超过10MB"})
-        
         # 保存文件
         student_path = os.path.join(app.config['UPLOAD_FOLDER'], 
                                    secure_filename(student_file.filename))
         book_path = os.path.join(app.config['UPLOAD_FOLDER'], 
                                 secure_filename(book_file.filename))
         
-        student_file.save(student_path)
-        book_file.save(book_path)
-        
+        # 分块落盘，任一时刻只驻留1MB缓冲，避免.save()整文件过内存
+        with open(student_path, 'wb') as out:
+            shutil.copyfileobj(student_file.stream, out, length=1024 * 1024)
+        with open(book_path, 'wb') as out:
+            shutil.copyfileobj(book_file.stream, out, length=1024 * 1024)
+
+        # Content-Length只能卡总量，落盘后再按单文件限额拦一次，超限不进解析
+        if (os.path.getsize(student_path) > MAX_FILE_SIZE or
+                os.path.getsize(book_path) > MAX_FILE_SIZE):
+            return jsonify({"success": False, "error": "文件过大，单个文件请不要超过10MB"})
+
         print(f"文件已保存，开始处理...")
         
         # 处理数据
-        result = process_data(student_path, book_path, college_name)
+        result = process_data(student_path, book_path, college_name, include_detail)
         
         if result['success']:
-            # 生成Excel
-            output = io.BytesIO()
-            with pd.ExcelWriter(output, engine='openpyxl') as writer:
-                result["result_df"].to_excel(writer, sheet_name='学院汇总', index=False)
-                result["detail_df"].to_excel(writer, sheet_name='购买明细', index=False)
-                pd.DataFrame([result["summary"]]).to_excel(writer, sheet_name='统计摘要', index=False)
-            
-            output.seek(0)
-            
-            # 保存结果
+            # 生成Excel：直接写到磁盘路径，省掉BytesIO+getvalue()把整份xlsx再拷贝一遍的峰值内存
             output_filename = f"统计_{college_name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
             output_path = os.path.join(app.config['UPLOAD_FOLDER'], output_filename)
-            
-            with open(output_path, 'wb') as f:
-                f.write(output.getvalue())
+
+            # 注意不能开constant_memory：to_excel按列写单元格，逐行刷盘会把
+            # 已刷行的后续列全部丢掉，导出的表只剩第一列和最后一行
+            with pd.ExcelWriter(output_path, engine='xlsxwriter') as writer:
+                result["result_df"].to_excel(writer, sheet_name='学院汇总', index=False)
+                if result["detail_df"] is not None:
+                    result["detail_df"].to_excel(writer, sheet_name='购买明细', index=False)
+                pd.DataFrame([result["summary"]]).to_excel(writer, sheet_name='统计摘要', index=False)
             
             # 立即删除输入文件
             try:
@@ -228,8 +320,6 @@ def process():
             except:
                 pass
             
-            gc.collect()
-            
             return jsonify({
                 "success": True,
                 "summary": result["summary"],
@@ -251,6 +341,7 @@ def process():
                 os.remove(book_path)
         except:
             pass
+        # DataFrame无环引用，del即按引用计数释放；只在请求收尾做一次整体回收
         gc.collect()
 
 @app.route('/download/<filename>')
@@ -260,14 +351,44 @@ def download(filename):
     if not os.path.exists(filepath):
         return jsonify({"error": "文件不存在"}), 404
     
-    try:
-        return send_file(filepath, as_attachment=True, download_name=filename)
-    finally:
-        # 下载后删除文件
+    # 不在发送后立即删除，交给后台线程按TTL清扫
+    return send_file(filepath, as_attachment=True, download_name=filename)
+
+def sweep_upload_folder():
+    now = time.time()
+    for name in os.listdir(app.config['UPLOAD_FOLDER']):
+        path = os.path.join(app.config['UPLOAD_FOLDER'], name)
         try:
-            os.remove(filepath)
-        except:
+            if os.path.isfile(path) and now - os.path.getmtime(path) > RESULT_TTL_SECONDS:
+                os.remove(path)
+        except OSError:
+            pass
+
+def sweep_book_cache():
+    # 按mtime只留最近的N份缓存，其余删掉
+    folder = app.config['BOOK_CACHE_FOLDER']
+    entries = []
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        try:
+            if os.path.isfile(path):
+                entries.append((os.path.getmtime(path), path))
+        except OSError:
             pass
+    entries.sort(reverse=True)
+    for _, path in entries[BOOK_CACHE_MAX_FILES:]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def _sweep_loop():
+    while True:
+        time.sleep(60)
+        sweep_upload_folder()
+        sweep_book_cache()
+
+threading.Thread(target=_sweep_loop, daemon=True).start()
 
 if __name__ == '__main__':
     import os